@@ -6,6 +6,9 @@
 ------------------------------\033[7m Whitewater Encoder \033[0m------------------------------
 
 \033[1mUsage:\033[0m
+  whitewater serve [--socket <path>] [--jobs <count>] [--queue <count>]
+  whitewater submit <file>... [--socket <path>] [options]
+  whitewater status [<job>] [--socket <path>]
   whitewater <file>... [options]
   whitewater (-h | --help | --version)
 
@@ -18,6 +21,29 @@
   --threshold <rms>     RMS threshold for determining whether a single cell of a
                         frame is different from the previous one. [default: 1.0]
   --format <filetype>   File format to save diffmap images as. [default: JPEG]
+  --auto-tune           Choose the blocksize and grid by sampling frames from
+                        the video. Overrides --blocksize and --grid.
+  --target-size <size>  Choose the JPEG quality automatically so the output
+                        fits within this many bytes. Accepts K and M suffixes.
+  --start <time>        First frame to encode, as a frame number (120), seconds
+                        (4.5s) or a timestamp (00:01:04.5).
+  --end <time>          Frame to stop before, in the same forms as --start.
+  --crop <box>          Only encode the region x,y,width,height of each frame.
+  --fps <rate>          Drop frames to reduce the video to this frame rate.
+  --checkpoint <count>  Save the encoder state every <count> frames so an
+                        interrupted encode can be resumed. [default: 0]
+  --workers <count>     Number of processes comparing frames. [default: 1]
+  --resume              Continue from a saved checkpoint. If the encode had
+                        finished and the video has grown, only the new frames
+                        are encoded.
+
+\033[1mService Options:\033[0m
+  --socket <path>       Unix socket of the encoder service.
+                        [default: /tmp/whitewater.sock]
+  --jobs <count>        Number of videos the service encodes at once.
+                        [default: 2]
+  --queue <count>       Maximum number of queued and running jobs.
+                        [default: 64]
 
 \033[1mHomepage:\033[0m
   \033[4mhttps://github.com/samiare/whitewater-encoder\033[0m
@@ -40,10 +66,12 @@ Whitewater Player Javascript library. More information can be found here:
 """
 
 
+import os
 import sys
+import socket
 
 from .__init__ import __version__
-from .whitewater import Whitewater
+from .whitewater import Whitewater, ProgramEnd
 from docopt import docopt
 
 
@@ -61,11 +89,21 @@ class Encoder(Whitewater):
         print Encoder.pad_line(message)
 
     def _pre_frame_hook(self, frame):
-        frames = int(self.video.get_meta_data()['nframes'])
+        frames = len(self.frame_indices)
         message = u'Processing frame %d of %d...' % (frame, frames)
         sys.stdout.write(Encoder.pad_line(message) + '\r')
         sys.stdout.flush()
 
+    def _post_auto_tune_hook(self, blocksize, grid):
+        message = u'\033[92mTUNED\033[0m blocksize %d, grid %d' % (blocksize, grid)
+        print Encoder.pad_line(message)
+
+    def _post_target_size_hook(self, quality, size):
+        target = self.options['target_size']
+        color = '\033[92m' if size <= target else '\033[91m'
+        message = u'%sQUALITY\033[0m %d (%d of %d bytes)' % (color, quality, size, target)
+        print Encoder.pad_line(message)
+
     def _post_save_hook(self, file_structure):
         print Encoder.pad_line('\033[0;96m' + self.paths['input'] + '\033[0m')
         for idx, filename in enumerate(file_structure):
@@ -87,6 +125,21 @@ class Encoder(Whitewater):
         return value
 
 
+def get_size(value):
+    """Convert a size such as ``500K`` or ``2M`` to a number of bytes."""
+
+    if not value:
+        return 0
+
+    value = value.strip().upper()
+    multipliers = {'K': 1024, 'M': 1024 * 1024}
+
+    if value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+
+    return int(value)
+
+
 def get_arguments():
     """Parse command line input."""
 
@@ -96,18 +149,81 @@ def get_arguments():
                'quality': int(arguments['--quality']),
                'threshold': float(arguments['--threshold']),
                'format': str(arguments['--format']),
-               'grid': int(arguments['--grid'])}
-
-    files = arguments['<file>']
+               'grid': int(arguments['--grid']),
+               'target_size': get_size(arguments['--target-size']),
+               'start': arguments['--start'],
+               'end': arguments['--end'],
+               'crop': arguments['--crop'],
+               'fps': float(arguments['--fps'] or 0),
+               'checkpoint': int(arguments['--checkpoint']),
+               'resume': arguments['--resume'],
+               'auto_tune': arguments['--auto-tune'],
+               'workers': int(arguments['--workers'])}
+
+    return arguments, options
+
+
+def serve(arguments):
+    """Run the encoder service until interrupted."""
+
+    from .service import EncoderService
+
+    try:
+        service = EncoderService(arguments['--socket'],
+                                 jobs=int(arguments['--jobs']),
+                                 queue=int(arguments['--queue']))
+    except ProgramEnd:
+        sys.exit(1)
+
+    message = u'\033[92mLISTENING\033[0m %s' % arguments['--socket']
+    print Encoder.pad_line(message)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        print Encoder.pad_line('\033[0;96m%s\033[0m' % 'exiting whitewater...')
+
+
+def send(arguments, message):
+    """Send a request to the encoder service and print the jobs it returns."""
+
+    from .service import request
+
+    try:
+        response = request(arguments['--socket'], message)
+    except socket.error as err:
+        sys.exit('could not reach service at %s: %s' % (arguments['--socket'], err))
+    except ValueError:
+        response = None
+
+    if not isinstance(response, dict):
+        sys.exit('no valid response from service at %s' % arguments['--socket'])
+
+    if 'error' in response:
+        sys.exit(response['error'])
+
+    for job in response['jobs']:
+        message = u'\033[92m%s\033[0m %d %s' % (job['status'].upper(), job['id'], job['path'])
+        if job['status'] == 'running':
+            message += ' (frame %d of %d)' % (job['frame'], job['frames'])
+        elif job['message']:
+            message += ' (%s)' % job['message']
+        print Encoder.pad_line(message)
 
-    return files, options
 
 def main():
     """Run the main program."""
 
-    paths, options = get_arguments()
+    arguments, options = get_arguments()
+
+    if arguments['serve']:
+        return serve(arguments)
+    elif arguments['submit']:
+        paths = [os.path.abspath(path) for path in arguments['<file>']]
+        return send(arguments, {'command': 'submit', 'files': paths, 'options': options})
+    elif arguments['status']:
+        return send(arguments, {'command': 'status', 'job': arguments['<job>']})
 
-    for path in paths:
+    for path in arguments['<file>']:
         encoder = Encoder(path, **options)
         try:
             encoder.encode()
@@ -0,0 +1,97 @@
+"""FrameRing
+
+This module contains a ring buffer of video frames in shared memory. It lets
+the processes of a multiprocess encode hand frames to each other without
+pickling or copying them: a producer writes a frame straight into a free slot,
+and consumers read the slot as a NumPy view of the same memory.
+"""
+
+
+import multiprocessing
+import numpy
+
+from multiprocessing.sharedctypes import RawArray
+
+
+class FrameRing(object):
+    """A fixed number of frame-sized slots in shared memory.
+
+    Free slot numbers are kept in a queue. A producer takes one with
+    ``acquire()``, blocking while every slot is in use, and a slot goes back
+    into rotation with ``release()`` once nothing reads it any more.
+
+    Must be created before the processes that use it are started, and passed
+    to them as an argument.
+
+    Args:
+        slots (int): Number of frames the ring can hold.
+        shape (tuple): Shape of a slot, usually the height, width and channels
+            of a frame.
+
+    Example:
+        >>> ring = FrameRing(4, (1080, 1920, 3))
+        >>> slot = ring.acquire()
+        >>> ring.view(slot)[...] = frame
+        >>> ring.release(slot)
+
+    """
+
+    def __init__(self, slots, shape):
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.__frame_size = int(numpy.prod(self.shape))
+        self.__buffer = RawArray('B', slots * self.__frame_size)
+        self.__free = multiprocessing.Queue()
+        self.__array = None
+
+        for slot in range(slots):
+            self.__free.put(slot)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_FrameRing__array'] = None
+        return state
+
+    def acquire(self):
+        """Take a free slot, waiting for one if necessary.
+
+        Returns:
+            int: a slot number
+        """
+
+        return self.__free.get()
+
+    def release(self, slot):
+        """Return a slot to the ring.
+
+        Args:
+            slot (int): a slot number from ``acquire()``
+        """
+
+        self.__free.put(slot)
+
+    def close(self):
+        """Stop using the ring in this process.
+
+        Waits until released slots have been handed to the queue, so they are
+        not written after the ring has been garbage collected.
+        """
+
+        self.__free.close()
+        self.__free.join_thread()
+
+    def view(self, slot):
+        """Get a slot as an array that shares its memory.
+
+        Args:
+            slot (int): a slot number
+
+        Returns:
+            ``numpy.ndarray``: a writable uint8 array of ``shape``
+        """
+
+        if self.__array is None:
+            self.__array = numpy.frombuffer(self.__buffer, numpy.uint8)
+
+        start = slot * self.__frame_size
+        return self.__array[start:start + self.__frame_size].reshape(self.shape)
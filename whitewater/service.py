@@ -0,0 +1,302 @@
+"""Service
+
+This module runs Whitewater as a long-lived encoding service. The service
+listens on a local Unix socket and hands videos to a pool of worker processes
+that have already imported the imaging libraries, so a batch of short clips
+does not pay the startup cost once per clip.
+
+Requests and responses are single lines of JSON:
+
+    {"command": "submit", "files": ["/path/to/video.mp4"], "options": {}}
+    {"command": "status", "job": 1}
+    {"command": "status"}
+"""
+
+
+import os
+import json
+import signal
+import socket
+import threading
+import itertools
+import multiprocessing
+import SocketServer
+
+from .whitewater import Whitewater, ProgramEnd, import_dependencies
+
+
+class EncoderService(object):
+    """A pool of warm encoder processes behind a Unix socket.
+
+    Args:
+        socket_path (str): Where to create the socket. A stale socket left by
+            a service that has stopped is replaced, but ``ProgramEnd`` is
+            raised if another service is still listening on it.
+        jobs (int): Number of videos to encode at once.
+        queue (int): Maximum number of queued and running jobs. Submissions
+            beyond this are rejected.
+
+    Example:
+        >>> service = EncoderService('/tmp/whitewater.sock', jobs=4)
+        >>> service.serve_forever()
+
+    """
+
+    def __init__(self, socket_path, jobs=2, queue=64):
+        _remove_stale_socket(socket_path)
+
+        self.socket_path = socket_path
+        self.limit = queue
+        self.jobs = {}
+        self.__ids = itertools.count(1)
+        self.__lock = threading.Lock()
+        self.__progress = multiprocessing.Queue()
+        self.__pool = multiprocessing.Pool(jobs,
+                                           initializer=_init_worker,
+                                           initargs=(self.__progress,))
+        self.__server = None
+
+    def serve_forever(self):
+        """Listen for requests until interrupted."""
+
+        self.__server = _UnixServer(self.socket_path, _RequestHandler)
+        self.__server.service = self
+
+        progress = threading.Thread(target=self._read_progress)
+        progress.daemon = True
+        progress.start()
+
+        try:
+            self.__server.serve_forever()
+        finally:
+            self.__server.server_close()
+            self.__pool.terminate()
+            os.remove(self.socket_path)
+
+    def handle(self, request):
+        """Respond to a single client request.
+
+        Args:
+            request (dict): a decoded request
+
+        Returns:
+            dict: the response to send back
+
+        """
+
+        if not isinstance(request, dict):
+            return {'error': 'request must be a JSON object'}
+
+        command = request.get('command')
+
+        if command == 'submit':
+            files = request.get('files', [])
+            options = request.get('options', {})
+
+            if (not isinstance(files, list) or
+                    not all(isinstance(path, basestring) for path in files)):
+                return {'error': 'files must be a list of paths'}
+            if not isinstance(options, dict):
+                return {'error': 'options must be a JSON object'}
+
+            return self.submit(files, options)
+        elif command == 'status':
+            return self.status(request.get('job'))
+
+        return {'error': 'unknown command \'%s\'' % command}
+
+    def submit(self, paths, options):
+        """Queue videos for encoding.
+
+        Args:
+            paths (list): absolute paths to video files
+            options (dict): ``Whitewater`` options applied to every video
+
+        Returns:
+            dict: the queued jobs, or an error if the queue is full
+
+        """
+
+        with self.__lock:
+            active = [job for job in self.jobs.itervalues()
+                      if job['status'] in ('queued', 'running')]
+            if len(active) + len(paths) > self.limit:
+                return {'error': 'queue is full (%d jobs)' % self.limit}
+
+            queued = []
+            for path in paths:
+                job = {'id': next(self.__ids),
+                       'path': path,
+                       'status': 'queued',
+                       'frame': 0,
+                       'frames': 0,
+                       'message': ''}
+                self.jobs[job['id']] = job
+                queued.append(dict(job))
+
+                self.__pool.apply_async(_run_job,
+                                        (job['id'], path, options),
+                                        callback=self._finish_job)
+
+        return {'jobs': queued}
+
+    def status(self, job_id=None):
+        """Report on one or all jobs.
+
+        Args:
+            job_id (int): a job id, or ``None`` for every job
+
+        Returns:
+            dict: the job status
+
+        """
+
+        with self.__lock:
+            if job_id is None:
+                return {'jobs': [dict(self.jobs[key]) for key in sorted(self.jobs)]}
+
+            try:
+                return {'jobs': [dict(self.jobs[int(job_id)])]}
+            except (KeyError, ValueError):
+                return {'error': 'no job \'%s\'' % job_id}
+
+    def _finish_job(self, result):
+        """Record the outcome of a job. Runs in the pool's result thread.
+
+        Args:
+            result (int, str, str): job id, final status and message
+
+        """
+
+        job_id, status, message = result
+        with self.__lock:
+            self.jobs[job_id]['status'] = status
+            self.jobs[job_id]['message'] = message
+
+    def _read_progress(self):
+        """Apply progress updates sent by the workers."""
+
+        while True:
+            job_id, frame, frames = self.__progress.get()
+            with self.__lock:
+                job = self.jobs[job_id]
+                if job['status'] == 'queued':
+                    job['status'] = 'running'
+                job['frame'] = frame
+                job['frames'] = frames
+
+
+def request(socket_path, message):
+    """Send a request to a running service and return its response.
+
+    Args:
+        socket_path (str): the service's socket
+        message (dict): the request
+
+    Returns:
+        dict: the decoded response
+
+    """
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall(json.dumps(message) + '\n')
+        response = client.makefile('r').readline()
+    finally:
+        client.close()
+
+    return json.loads(response)
+
+
+def _remove_stale_socket(socket_path):
+    """Remove a socket left behind by a service that is no longer running.
+
+    Args:
+        socket_path (str): the socket to check
+
+    """
+
+    if not os.path.exists(socket_path):
+        return
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except socket.error:
+        os.remove(socket_path)
+        return
+    finally:
+        client.close()
+
+    raise ProgramEnd('a service is already listening on %s' % socket_path)
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Threaded Unix socket server."""
+
+    daemon_threads = True
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    """Reads one JSON request per connection and writes one JSON response."""
+
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline())
+            response = self.server.service.handle(message)
+        except ValueError as err:
+            response = {'error': str(err)}
+
+        self.wfile.write(json.dumps(response) + '\n')
+
+
+class _ServiceEncoder(Whitewater):
+    """Subclass of Whitewater that reports progress to the service."""
+
+    progress = None
+
+    def __init__(self, job_id, path_to_file, **kwargs):
+        self.job_id = job_id
+        super(_ServiceEncoder, self).__init__(path_to_file, **kwargs)
+
+    def _pre_frame_hook(self, frame):
+        frames = len(self.frame_indices)
+        _ServiceEncoder.progress.put((self.job_id, frame, frames))
+
+
+def _init_worker(progress):
+    """Prepare a pool process to run jobs.
+
+    Args:
+        progress (``multiprocessing.Queue``): where to send progress updates
+
+    """
+
+    # Ctrl-C reaches every process in the group; the parent stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    _ServiceEncoder.progress = progress
+    import_dependencies()
+
+
+def _run_job(job_id, path, options):
+    """Encode a single video inside a pool process.
+
+    Args:
+        job_id (int): the job id
+        path (str): path to the video file
+        options (dict): ``Whitewater`` options
+
+    Returns:
+        (int, str, str): job id, final status and message
+
+    """
+
+    try:
+        encoder = _ServiceEncoder(job_id, path, **options)
+        return job_id, 'finished', encoder.encode()
+    except ProgramEnd as err:
+        return job_id, 'failed', str(err.message)
+    except Exception as err:
+        return job_id, 'failed', str(err)
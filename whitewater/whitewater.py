@@ -1,20 +1,50 @@
 """Whitewater
 
 This module contains one public facing class -- Whitewater -- along with a
-helper class and custom Exception. It provides the main logic of converting a
-video into the format read by the Whitewater Video Decoder Javascript library.
+helper class, custom Exception, a function for preloading the imaging
+libraries and the worker functions of a multiprocess encode. It provides the
+main logic of converting a video into the format read by the Whitewater Video
+Decoder Javascript library.
 """
 
 
+import io
 import os
 import sys
 import math
 import json
 import tempfile
 import shutil
-import imageio
+import multiprocessing
+import Queue
 
-from PIL import Image, ImageChops
+# imageio, numpy and PIL are slow to import, so they are loaded on first use
+# by ``import_dependencies()`` rather than here.
+imageio = None
+numpy = None
+Image = None
+FrameRing = None
+
+
+def import_dependencies():
+    """Import the imaging libraries used for encoding.
+
+    Called automatically when a ``Whitewater`` instance is created. Calling it
+    ahead of time keeps the import cost out of the first encode.
+    """
+
+    global imageio, numpy, Image, FrameRing
+
+    if imageio is None:
+        import imageio as _imageio
+        import numpy as _numpy
+        from PIL import Image as _Image
+        from .framering import FrameRing as _FrameRing
+
+        imageio = _imageio
+        numpy = _numpy
+        Image = _Image
+        FrameRing = _FrameRing
 
 
 class Whitewater(object):
@@ -34,6 +64,30 @@ class Whitewater(object):
         threshold (float): RMS threshold for determining whether a single cell
             of a frame is different from the previous one. *Default:* ``1.0``
         format (str): File format to save diffmap images as. *Default:* ``"JPEG"``
+        target_size (int): Maximum size of the encoded output in bytes. When
+            set, the JPEG quality is chosen automatically so the output fits
+            this budget and ``quality`` is ignored. *Default:* ``0`` (off)
+        start (str): First frame to encode, as a frame number (``"120"``),
+            seconds (``"4.5s"``) or a timestamp (``"00:01:04.5"``).
+            *Default:* ``None`` (the first frame)
+        end (str): Frame to stop before, in the same forms as ``start``.
+            *Default:* ``None`` (the last frame)
+        crop (str): Region to encode, as ``"x,y,width,height"`` in pixels.
+            *Default:* ``None`` (the full frame)
+        fps (float): Frame rate to reduce the video to by dropping frames.
+            Ignored if it is not lower than the source frame rate.
+            *Default:* ``0`` (the source frame rate)
+        checkpoint (int): Save the encoder state every this many frames so an
+            interrupted encode can be resumed. *Default:* ``0`` (off)
+        resume (bool): Continue from a saved checkpoint instead of starting
+            over. If the encode had finished and the video has grown since,
+            only the new frames are encoded. *Default:* ``False``
+        auto_tune (bool): Choose ``blocksize`` and ``grid`` by sampling frame
+            pairs from the video and estimating the output size of each
+            candidate. *Default:* ``False``
+        workers (int): Number of processes comparing frames. Above ``1``,
+            a separate process decodes frames into shared memory while the
+            workers compare them. *Default:* ``1``
 
     Example:
         >>> encoder = Whitewater('path/to/video.mp4', options)
@@ -50,13 +104,41 @@ class Whitewater(object):
                         'quality': 75,
                         'threshold': 1.0,
                         'format': 'JPEG',
+                        'target_size': 0,
+                        'start': None,
+                        'end': None,
+                        'crop': None,
+                        'fps': 0.0,
+                        'checkpoint': 0,
+                        'resume': False,
+                        'auto_tune': False,
+                        'workers': 1,
                         'debug': False}
+    _JPEG_OPTIONS = {'subsampling': 1,
+                     'optimize': True}
+    _QUALITY_RANGE = (1, 95)
+    _SIZE_SAMPLE_LIMIT = 8
+    _CHECKPOINT_OPTIONS = ('blocksize', 'grid', 'threshold', 'start', 'crop', 'fps')
+    _AUTO_TUNE_BLOCKSIZES = (32, 16, 8, 4)
+    _AUTO_TUNE_DIFFMAP_SIZES = (2048, 1024)
+    _AUTO_TUNE_SAMPLES = 8
+    _AUTO_TUNE_BLOCK_LIMIT = 1024
+    _IMAGE_OVERHEAD = 4096
+    _MAX_POSITIONS = 64 ** 3
+    _MAX_CONSECUTIVE = 64 ** 2 - 1
 
     def __init__(self, path_to_file, **kwargs):
+        import_dependencies()
+
         self.debug = kwargs['debug'] if 'debug' in kwargs else False
         self.paths = {'input': path_to_file,
                       'output': self._get_output_directory(path_to_file)}
+        self.paths['checkpoint'] = self.paths['output'] + '.checkpoint'
         self.options = self._get_options(kwargs)
+
+        if self.options['target_size'] and self.options['format'] != 'JPEG':
+            self.exit('target size requires the JPEG format')
+
         self.tracker = FrameTracker(self.options['blocksize'], self.options['grid'])
 
         try:
@@ -64,8 +146,12 @@ class Whitewater(object):
         except IOError:
             self.exit('video not found')
 
+        self.frame_size = self._get_frame_size()
+        self.frame_indices = self._get_frame_indices()
         self.frame_maps = []
         self.consecutive = 0
+        self.next_index = 0
+        self.checkpointed = 0
 
     def encode(self):
         """Encode a video file into the whitewater format.
@@ -76,17 +162,43 @@ class Whitewater(object):
         """
 
         self._pre_encode_hook()
-        for frame in enumerate(self.video):
-            frame_number = frame[0] + 1
+        resuming = self.options['resume'] and os.path.exists(self.paths['checkpoint'])
 
-            self._pre_frame_hook(frame_number)
-            self._process_frame(frame)
-            self._post_frame_hook(frame_number)
+        if self.options['auto_tune'] and not resuming:
+            self._auto_tune()
+            self._post_auto_tune_hook(self.options['blocksize'], self.options['grid'])
+
+        if resuming:
+            self._load_checkpoint()
+
+        # daemonic processes, like the service's workers, cannot start children
+        if self.options['workers'] > 1 and not multiprocessing.current_process().daemon:
+            self._encode_frames_in_parallel()
+        else:
+            self._encode_frames()
+
+        if self.options['checkpoint']:
+            self._save_checkpoint()
 
         self._pre_save_hook()
+        if self.options['target_size']:
+            self.options['quality'] = self._find_quality_for_target_size()
+
         self._create_output_directory()
         self._save_images()
         self._save_manifest()
+        if self.options['target_size']:
+            size = self._get_directory_size(self.paths['temp'])
+
+            # the search works from an estimate, so step down until it fits
+            while (size > self.options['target_size'] and
+                   self.options['quality'] > Whitewater._QUALITY_RANGE[0]):
+                self.options['quality'] -= 1
+                self._save_images()
+                size = self._get_directory_size(self.paths['temp'])
+
+            self._post_target_size_hook(self.options['quality'], size)
+
         self._copy_temp_directory()
         self._post_save_hook(os.listdir(self.paths['output']))
         self._post_encode_hook()
@@ -112,21 +224,23 @@ class Whitewater(object):
 
     # start _private methods
 
-    def _add_to_diffmap(self, block):
-        """Adds an image block to the current diffmap.
+    def _add_to_diffmap(self, blocks):
+        """Copies a run of blocks into the current row of the diffmap.
 
         Args:
-            block (``PIL.Image.Image``): a pixel block
+            blocks (``numpy.ndarray``): consecutive blocks that fit in what is
+                left of the row
 
         """
 
-        x_0 = self.tracker.x_val * self.options['blocksize']
-        y_0 = self.tracker.y_val * self.options['blocksize']
-        x_1 = x_0 + self.options['blocksize']
-        y_1 = y_0 + self.options['blocksize']
+        count, blocksize = blocks.shape[:2]
+        x_0 = self.tracker.x_val * blocksize
+        y_0 = self.tracker.y_val * blocksize
 
-        self.tracker.diffmap.paste(block, (x_0, y_0, x_1, y_1))
-        self.tracker.next_cell()
+        # side by side, the blocks of a run are a single slice of the row
+        run = blocks.transpose(1, 0, 2, 3).reshape(blocksize, count * blocksize, 3)
+        self.tracker.diffmap[y_0:y_0 + blocksize, x_0:x_0 + count * blocksize] = run
+        self.tracker.next_cell(count)
 
     def _add_to_framemap(self, position):
         """Converts position and consecutive values to a base64 representation.
@@ -147,82 +261,296 @@ class Whitewater(object):
 
         return position_64 + consecutive_64
 
-    def _compare_images(self, im1, im2):
-        """Compares two images for similarity.
+    def _auto_tune(self):
+        """Choose ``blocksize`` and ``grid`` from a sample of frame pairs.
 
-        Args:
-            im1 (``PIL.Image.Image``): an image to be compared
-            im2 (``PIL.Image.Image``): an image to be compared
-
-        Returns:
-            bool: ``False`` if similar and ``True`` if not.
+        For each candidate blocksize, the changed blocks of the sampled pairs
+        are counted and compressed to estimate the bytes per block. Each
+        blocksize and diffmap size combination is then scored by its
+        estimated image data, frame map data and per-image overhead, and the
+        cheapest one is used. Ties go to the larger blocksize, which encodes
+        faster.
 
+        Combinations the frame map cannot represent are skipped: positions
+        are 3 base64 characters and run lengths, which never exceed the
+        smaller of the frame's columns and the grid, are 2.
         """
 
-        diff = ImageChops.difference(im1, im2)
-        bbox = diff.getbbox()
-        if not bbox:
-            return False
-        else:
-            histogram = diff.histogram()
-            squares = (value * ((idx % 256) ** 2) for idx, value in enumerate(histogram))
-            sum_of_squares = sum(squares)
-            rms = math.sqrt(sum_of_squares/float(im1.size[0] * im1.size[1]))
+        indices = self.frame_indices
+        count = min(Whitewater._AUTO_TUNE_SAMPLES, len(indices) - 1)
+        if count < 1:
+            return
 
-            if rms <= self.options['threshold']:
-                return False
-            else:
-                return True
+        pairs = []
+        for i in range(count):
+            position = 1 + i * (len(indices) - 2) // max(count - 1, 1)
+            frames = []
+            try:
+                for index in (indices[position - 1], indices[position]):
+                    data = self.video.get_data(index)
+                    frames.append(numpy.asarray(self._get_image_from_frame_data(data)))
+            except IndexError:
+                # nframes can overstate the length of the video
+                continue
+            pairs.append(frames)
+
+        if not pairs:
+            return
+
+        scale = (len(indices) - 1) / float(len(pairs))
+        width, height = self.frame_size
+        candidates = []
+
+        for blocksize in Whitewater._AUTO_TUNE_BLOCKSIZES:
+            columns = int(math.ceil(width / float(blocksize)))
+            rows = int(math.ceil(height / float(blocksize)))
+            if columns * rows > Whitewater._MAX_POSITIONS:
+                continue
+
+            changed_count = 0
+            run_count = 0
+            blocks = []
+
+            for previous, current in pairs:
+                changed = self._get_changed_blocks(previous, current, blocksize,
+                                                   self.options['threshold'])
+                changed_count += numpy.count_nonzero(changed)
+                run_count += numpy.count_nonzero(changed[:, 0])
+                run_count += numpy.count_nonzero(changed[:, 1:] & ~changed[:, :-1])
+
+                limit = Whitewater._AUTO_TUNE_BLOCK_LIMIT - len(blocks)
+                if limit > 0:
+                    blocks.extend(self._get_blocks(current, changed, blocksize)[:limit])
+
+            changed_count *= scale
+            block_bytes = self._estimate_block_bytes(blocks, blocksize)
+
+            for size in Whitewater._AUTO_TUNE_DIFFMAP_SIZES:
+                grid = size // blocksize
+                if min(columns, grid) > Whitewater._MAX_CONSECUTIVE:
+                    continue
+
+                images = max(int(math.ceil(changed_count / (grid * grid))), 1)
+                cost = (changed_count * block_bytes +
+                        run_count * scale * 5 +
+                        images * Whitewater._IMAGE_OVERHEAD)
+                candidates.append((cost, blocksize, grid))
+
+        if not candidates:
+            return
+
+        cost, blocksize, grid = min(candidates, key=lambda candidate: candidate[0])
+        self.options['blocksize'] = blocksize
+        self.options['grid'] = grid
+        self.tracker = FrameTracker(blocksize, grid)
 
     def _compare_to_previous_frame(self):
         """Compare current frame to the previous one.
 
-        Loops through the blocks of each frame pair, appends frame data to
+        Finds the changed blocks of the frame pair, appends frame data to
         ``self.frame_maps`` and adds image data to diffmaps.
 
         """
 
-        size = self.video.get_meta_data()['source_size']
-        columns = int(math.ceil(size[0] / float(self.options['blocksize'])))
-        rows = int(math.ceil(size[1] / float(self.options['blocksize'])))
+        blocksize = self.options['blocksize']
+        previous = numpy.asarray(self.tracker.previous_frame)
+        current = numpy.asarray(self.tracker.current_frame)
 
-        position = 0
-        frame_map = ''
+        changed = self._get_changed_blocks(previous, current, blocksize,
+                                           self.options['threshold'])
+        self._pack_frame(changed, self._get_blocks(current, changed, blocksize))
+
+    def _encode_frames(self):
+        """Read and process each frame in turn."""
+
+        for number, index in enumerate(self.frame_indices):
+            if index < self.next_index:
+                continue
+
+            try:
+                data = self.video.get_data(index)
+            except IndexError:
+                break
+
+            frame_number = number + 1
+
+            self._pre_frame_hook(frame_number)
+            self._process_frame((number, data))
+            self.next_index = index + 1
+            self._post_frame_hook(frame_number)
+
+            if self.options['checkpoint'] and frame_number % self.options['checkpoint'] == 0:
+                self._save_checkpoint()
+
+    def _encode_frames_in_parallel(self):
+        """Process frames with a decoder process and comparison workers.
+
+        The decoder writes frames into a shared ``FrameRing`` and queues each
+        frame pair for the workers. A worker compares the pair in place, copies
+        the changed blocks into a slot of a second ring, and sends back which
+        blocks changed and where it put them. Results are packed here in frame
+        order; the diffmap position of every block follows from the number of
+        blocks packed before it, so packing is only slice copies.
+
+        A frame slot is released once the frame after it has been packed, and
+        a block slot once its own frame has, since nothing reads them after
+        that. Both rings have the same number of slots, so a worker never
+        waits for a block slot that only a later frame could free.
+        """
 
-        for row in xrange(0, rows):
-            # for each row of a video frame
-            self.consecutive = 0
+        skipped = [index for index in self.frame_indices if index < self.next_index]
+        indices = self.frame_indices[len(skipped):]
+        width, height = self.frame_size
+        workers = self.options['workers']
+        blocksize = self.options['blocksize']
+        columns = int(math.ceil(width / float(blocksize)))
+        rows = int(math.ceil(height / float(blocksize)))
+
+        previous = None
+        if self.tracker.current_frame is not None:
+            previous = numpy.asarray(self.tracker.current_frame)
+
+        ring = FrameRing(workers * 2 + 2, (height, width, 3))
+        tiles = FrameRing(ring.slots, (rows * columns, blocksize, blocksize, 3))
+        tasks = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+
+        processes = [multiprocessing.Process(target=_decode_frames,
+                                             args=(self.paths['input'], self.options['crop'],
+                                                   indices, previous, ring, tasks, results,
+                                                   workers))]
+        for _ in range(workers):
+            processes.append(multiprocessing.Process(target=_compare_frames,
+                                                     args=(ring, tiles, tasks, results,
+                                                           blocksize,
+                                                           self.options['threshold'])))
+        for process in processes:
+            process.daemon = True
+            process.start()
+
+        pending = {}
+        packed = 0
+        total = None
+        last_slot = None
 
-            for column in xrange(0, columns):
-                # for each column in a row of the video frame
-                box = self._get_box_coords(row, column, self.options['blocksize'])
+        try:
+            while total is None or packed < total:
+                message = self._get_worker_result(results, processes)
+
+                if message[0] == 'end':
+                    total, last_slot = message[1:]
+                    continue
+
+                pending[message[1]] = message[2:]
+
+                while packed in pending:
+                    index, previous_slot, slot, changed, tile = pending.pop(packed)
+                    frame_number = len(skipped) + packed + 1
+                    current = ring.view(slot)
+
+                    self._pre_frame_hook(frame_number)
+                    if previous_slot is None:
+                        image = Image.fromarray(numpy.array(current), 'RGB')
+                        self.tracker.set_next_frame(image)
+                        self.tracker.set_first_image(numpy.array(current))
+                    else:
+                        if changed is None:
+                            self.frame_maps.append('')
+                        else:
+                            self._pack_frame(changed, tiles.view(tile))
+                            tiles.release(tile)
+                        ring.release(previous_slot)
+                    self.next_index = index + 1
+                    self._post_frame_hook(frame_number)
+
+                    interval = self.options['checkpoint']
+                    if interval and frame_number % interval == 0:
+                        image = Image.fromarray(numpy.array(current), 'RGB')
+                        self.tracker.set_next_frame(image)
+                        self._save_checkpoint()
+
+                    packed += 1
+
+            if last_slot is not None:
+                last_frame = numpy.array(ring.view(last_slot))
+                self.tracker.set_next_frame(Image.fromarray(last_frame, 'RGB'))
+
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+            ring.close()
+            tiles.close()
+
+    def _get_worker_result(self, results, processes):
+        """Wait for the next message from the processes of a parallel encode.
+
+        Args:
+            results (``multiprocessing.Queue``): the result queue
+            processes (list): the decoder and worker processes
 
-                temp_0 = Image.new('RGB', (self.options['blocksize'], self.options['blocksize']))
-                temp_0.paste(self.tracker.previous_frame.crop(box))
+        Returns:
+            tuple: the message
 
-                temp_1 = Image.new('RGB', (self.options['blocksize'], self.options['blocksize']))
-                temp_1.paste(self.tracker.current_frame.crop(box))
+        """
 
-                if self._compare_images(temp_0, temp_1):
-                    self.consecutive += 1
-                    self._add_to_diffmap(temp_1)
+        while True:
+            try:
+                message = results.get(timeout=1)
+            except Queue.Empty:
+                if any(process.exitcode for process in processes):
+                    self.exit('an encoder process exited unexpectedly')
+                continue
 
-                    if self.tracker.x_val == 0:
-                        frame_map += self._add_to_framemap(position - self.consecutive + 1)
-                        self.consecutive = 0
+            if message[0] == 'error':
+                self.exit(message[1])
 
-                elif self.consecutive > 0:
-                    frame_map += self._add_to_framemap(position - self.consecutive)
-                    self.consecutive = 0
+            return message
 
-                temp_0.close()
-                temp_1.close()
-                position += 1
+    def _pack_frame(self, changed, blocks):
+        """Add the changed blocks of a frame to the diffmaps.
+
+        Each run of changed blocks in a row of the frame is copied into the
+        diffmap at once, split where it reaches the end of a diffmap row.
+        Appends the frame's map to ``self.frame_maps``.
+
+        Args:
+            changed (``numpy.ndarray``): the changed block mask from
+                ``_get_changed_blocks()``
+            blocks (``numpy.ndarray``): the changed blocks, row by row, as
+                returned by ``_get_blocks()``
+
+        """
 
-            if self.consecutive > 0:
-                frame_map += self._add_to_framemap(position - self.consecutive)
-                self.consecutive = 0
+        rows, columns = changed.shape
+        grid = self.options['grid']
 
+        # runs start where a row goes from unchanged to changed, and end
+        # where it goes back
+        edges = numpy.zeros((rows, columns + 2), numpy.int8)
+        edges[:, 1:-1] = changed
+        edges = numpy.diff(edges, axis=1)
+        starts = numpy.nonzero(edges == 1)
+        ends = numpy.nonzero(edges == -1)[1]
+
+        frame_map = ''
+        packed = 0
+
+        for row, column, end in zip(starts[0], starts[1], ends):
+            position = int(row) * columns + int(column)
+            remaining = int(end - column)
+
+            while remaining:
+                self.consecutive = min(remaining, grid - self.tracker.x_val)
+                frame_map += self._add_to_framemap(position)
+                self._add_to_diffmap(blocks[packed:packed + self.consecutive])
+
+                packed += self.consecutive
+                position += self.consecutive
+                remaining -= self.consecutive
+
+        self.consecutive = 0
         self.frame_maps.append(frame_map)
 
     def _copy_temp_directory(self):
@@ -254,6 +582,109 @@ class Whitewater(object):
         except OSError as err:
             self.exit(err)
 
+    def _estimate_output_size(self, quality):
+        """Estimate the size of the encoded output at a given JPEG quality.
+
+        The first image and the last diffmap, which is cropped and usually
+        smaller than the rest, are always compressed. When there are more full
+        diffmaps than ``_SIZE_SAMPLE_LIMIT``, an evenly spaced sample of them
+        is compressed and the result scaled up to the full count.
+
+        Args:
+            quality (int): a JPEG quality setting
+
+        Returns:
+            int: the estimated size in bytes
+
+        """
+
+        size = self._get_encoded_size(self._get_output_image(0), quality)
+
+        count = self.tracker.diffmap_count
+        if count:
+            size += self._get_encoded_size(self._get_output_image(count), quality)
+
+        full = count - 1
+        limit = Whitewater._SIZE_SAMPLE_LIMIT
+        if full <= limit:
+            sample = range(1, full + 1)
+        else:
+            sample = [1 + i * (full - 1) // (limit - 1) for i in range(limit)]
+
+        if sample:
+            sample_size = sum(self._get_encoded_size(self._get_output_image(i), quality)
+                              for i in sample)
+            size += sample_size * full // len(sample)
+
+        manifest = json.dumps(self._get_manifest(), indent=4)
+        return size + len(manifest)
+
+    def _estimate_block_bytes(self, blocks, blocksize):
+        """Estimate the compressed size of one block in a diffmap.
+
+        Args:
+            blocks (list): ``numpy.ndarray`` blocks of ``blocksize`` pixels
+            blocksize (int): the width/height of a block
+
+        Returns:
+            float: the estimated size in bytes
+
+        """
+
+        if not blocks:
+            return 0.0
+
+        columns = min(len(blocks), 32)
+        rows = int(math.ceil(len(blocks) / float(columns)))
+        tile = numpy.zeros((rows * blocksize, columns * blocksize, 3), numpy.uint8)
+
+        for i, block in enumerate(blocks):
+            y_0 = (i // columns) * blocksize
+            x_0 = (i % columns) * blocksize
+            tile[y_0:y_0 + blocksize, x_0:x_0 + blocksize] = block
+
+        image = Image.fromarray(tile, 'RGB')
+        return self._get_encoded_size(image, self.options['quality']) / float(len(blocks))
+
+    def _find_quality_for_target_size(self):
+        """Binary search the highest JPEG quality that fits ``target_size``.
+
+        Falls back to the lowest quality if nothing fits.
+
+        Returns:
+            int: a JPEG quality setting
+
+        """
+
+        low, high = Whitewater._QUALITY_RANGE
+        best = low
+
+        while low <= high:
+            quality = (low + high) // 2
+            if self._estimate_output_size(quality) <= self.options['target_size']:
+                best = quality
+                low = quality + 1
+            else:
+                high = quality - 1
+
+        return best
+
+    def _get_encoded_size(self, image, quality):
+        """Compress an image in memory and measure it.
+
+        Args:
+            image (``PIL.Image.Image``): the image to compress
+            quality (int): a JPEG quality setting (ignored for other formats)
+
+        Returns:
+            int: the compressed size in bytes
+
+        """
+
+        buf = io.BytesIO()
+        self._write_image(image, buf, quality)
+        return buf.tell()
+
     def _get_image_from_frame_data(self, frame_data):
         """Convert an image from data to a usable format.
 
@@ -269,7 +700,103 @@ class Whitewater(object):
         size = self.video.get_meta_data()['source_size']
         decoder = 'raw'
 
-        return Image.frombuffer(mode, size, frame_data, decoder, mode, 0, 1)
+        image = Image.frombuffer(mode, size, frame_data, decoder, mode, 0, 1)
+
+        if self.options['crop']:
+            x_0, y_0, width, height = self.options['crop']
+            image = image.crop((x_0, y_0, x_0 + width, y_0 + height))
+
+        return image
+
+    def _get_frame_index(self, value):
+        """Convert a frame number, seconds or timestamp to a frame index.
+
+        Args:
+            value (str): ``"120"``, ``"4.5s"`` or ``"00:01:04.5"``
+
+        Returns:
+            int: a zero-based frame index
+
+        """
+
+        if ':' in value:
+            parts = reversed(value.split(':'))
+            seconds = sum(float(part) * 60 ** i for i, part in enumerate(parts))
+        elif value.endswith('s'):
+            seconds = float(value[:-1])
+        else:
+            return int(value)
+
+        return int(round(seconds * self.video.get_meta_data()['fps']))
+
+    def _get_frame_indices(self):
+        """Get the indices of the source frames to encode.
+
+        Returns:
+            list: frame indices in ascending order
+
+        """
+
+        total = int(self.video.get_meta_data()['nframes'])
+        start, end = 0, total
+
+        try:
+            if self.options['start'] is not None:
+                start = self._get_frame_index(self.options['start'])
+            if self.options['end'] is not None:
+                end = min(self._get_frame_index(self.options['end']), total)
+        except ValueError as err:
+            self.exit(err)
+
+        if not 0 <= start < end:
+            self.exit('no frames between start and end')
+
+        step = self.video.get_meta_data()['fps'] / self._get_frames_per_second()
+        indices = []
+        index = start
+
+        while index < end:
+            indices.append(index)
+            index = start + int(round(len(indices) * step))
+
+        return indices
+
+    def _get_frames_per_second(self):
+        """Get the frame rate of the encoded video.
+
+        Returns:
+            float: ``fps`` if it is lower than the source frame rate,
+                otherwise the source frame rate
+
+        """
+
+        source = self.video.get_meta_data()['fps']
+
+        if 0 < self.options['fps'] < source:
+            return self.options['fps']
+
+        return source
+
+    def _get_frame_size(self):
+        """Get the size of the encoded area, checking ``crop`` against the
+        source.
+
+        Returns:
+            (int, int): width and height in pixels
+
+        """
+
+        size = self.video.get_meta_data()['source_size']
+
+        if not self.options['crop']:
+            return size
+
+        x_0, y_0, width, height = self.options['crop']
+        if (x_0 < 0 or y_0 < 0 or width <= 0 or height <= 0 or
+                x_0 + width > size[0] or y_0 + height > size[1]):
+            self.exit('crop region is outside of the %dx%d frame' % tuple(size))
+
+        return (width, height)
 
     def _get_options(self, kwargs):
         """Set video encoder options
@@ -282,14 +809,20 @@ class Whitewater(object):
 
         """
         try:
-            options = Whitewater._OPTION_DEFAULTS
+            options = dict(Whitewater._OPTION_DEFAULTS)
             for key, value in kwargs.iteritems():
-                if key == 'threshold':
+                if key in ('threshold', 'fps'):
                     if not isinstance(options[key], bool):
                         options[key] = float(value)
                 elif key == 'format':
                     if not isinstance(options[key], bool):
                         options[key] = str(value)
+                elif key in ('start', 'end'):
+                    options[key] = None if value is None else str(value)
+                elif key == 'crop':
+                    options[key] = self._get_crop(value)
+                elif key in ('resume', 'auto_tune'):
+                    options[key] = bool(value)
                 else:
                     if not isinstance(options[key], bool):
                         options[key] = int(value)
@@ -298,6 +831,93 @@ class Whitewater(object):
 
         return options
 
+    def _get_checkpoint_options(self):
+        """Get the options a checkpoint has to agree with to be resumed.
+
+        Returns:
+            dict: the options, as they are stored in a checkpoint
+
+        """
+
+        options = dict((key, self.options[key]) for key in Whitewater._CHECKPOINT_OPTIONS)
+        return json.loads(json.dumps(options))
+
+    def _load_checkpoint(self):
+        """Restore the encoder state saved by ``_save_checkpoint()``."""
+
+        path = self.paths['checkpoint']
+
+        try:
+            with open(os.path.join(path, 'state.json')) as state_file:
+                state = json.load(state_file)
+
+            if self.options['auto_tune']:
+                self.options['blocksize'] = state['options']['blocksize']
+                self.options['grid'] = state['options']['grid']
+                self.tracker = FrameTracker(self.options['blocksize'], self.options['grid'])
+
+            if state['options'] != self._get_checkpoint_options():
+                self.exit('%s was made with different options' % path)
+
+            images = []
+            for name in state['images']:
+                image = Image.open(os.path.join(path, name))
+                images.append(numpy.array(image.convert('RGB')))
+
+            last_frame = Image.open(os.path.join(path, state['last'])).convert('RGB')
+        except (IOError, OSError, KeyError, ValueError) as err:
+            self.exit('could not resume from %s: %s' % (path, err))
+
+        self.tracker.restore(images, state['cell'], last_frame)
+        self.frame_maps = state['frame_maps']
+        self.next_index = state['next_index']
+        self.checkpointed = len(images) - 1
+
+    def _save_checkpoint(self):
+        """Save the encoder state so the encode can be resumed.
+
+        Diffmaps that were already saved as complete are not written again.
+        The last frame and the diffmap still being filled are saved under
+        names that include ``next_index``, so they never replace the files an
+        older ``state.json`` refers to. Renaming ``state.json`` into place is
+        the single point where the new checkpoint takes effect; files only
+        the previous state used are removed afterwards.
+        """
+
+        path = self.paths['checkpoint']
+        images = self.tracker.diffmaps
+        suffix = '_%d.png' % self.next_index
+
+        names = ['image_%d.png' % i for i in range(len(images) - 1)]
+        names.append('image_%d%s' % (len(images) - 1, suffix))
+        last = 'last' + suffix
+
+        try:
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+            for i in range(self.checkpointed, len(images)):
+                image = Image.fromarray(images[i], 'RGB')
+                self._save_checkpoint_file(image, path, names[i])
+            self._save_checkpoint_file(self.tracker.current_frame, path, last)
+
+            state = {'version': 1,
+                     'options': self._get_checkpoint_options(),
+                     'next_index': self.next_index,
+                     'images': names,
+                     'last': last,
+                     'cell': [self.tracker.x_val, self.tracker.y_val],
+                     'frame_maps': self.frame_maps}
+            self._save_checkpoint_file(state, path, 'state.json')
+
+            for filename in os.listdir(path):
+                if filename not in names and filename not in (last, 'state.json'):
+                    os.remove(os.path.join(path, filename))
+        except (IOError, OSError) as err:
+            self.exit(err)
+
+        self.checkpointed = len(images) - 1
+
     def _save_image_as(self, image, name):
         """Create and save a diffmap image file.
 
@@ -307,54 +927,99 @@ class Whitewater(object):
 
         """
 
-        try:
-            if self.options['format'] == 'JPEG':
-                filename = name + '.jpg'
-                image.save(os.path.join(self.paths['temp'], filename),
-                           'JPEG',
-                           quality=self.options['quality'],
-                           subsampling=1,
-                           optimize=True)
-
-            elif self.options['format'] == 'PNG':
-                filename = name + '.png'
-                image.save(os.path.join(self.paths['temp'], filename),
-                           'PNG',
-                           optimize=True)
-
-            else:
-                filename = name + '.gif'
-                image.save(os.path.join(self.paths['temp'], filename), 'GIF')
+        extensions = {'JPEG': '.jpg', 'PNG': '.png'}
+        filename = name + extensions.get(self.options['format'], '.gif')
 
+        try:
+            self._write_image(image,
+                              os.path.join(self.paths['temp'], filename),
+                              self.options['quality'])
         except IOError as err:
             self.exit(err)
 
     def _save_images(self):
         """Loops through the stored images and saves them."""
 
-        for i, image in enumerate(self.tracker.diffmaps):
+        for i in range(len(self.tracker.diffmaps)):
             if i == 0:
                 name = 'first'
             else:
                 suffix = self._get_padded_string(str(i), 3, '0')
                 name = 'diff_' + suffix
-            self._save_image_as(image, name)
+            self._save_image_as(self._get_output_image(i), name)
+
+    def _get_output_image(self, index):
+        """Get an image as it will be saved.
+
+        The last diffmap is cropped to the rows that contain blocks.
+
+        Args:
+            index (int): ``0`` for the first image, otherwise a diffmap number
+
+        Returns:
+            ``PIL.Image.Image``: the image
+
+        """
+
+        image = self.tracker.diffmaps[index]
+
+        if index > 0 and index == self.tracker.diffmap_count:
+            image = image[:self._get_last_diffmap_height()]
+
+        return Image.fromarray(image, 'RGB')
+
+    def _get_last_diffmap_height(self):
+        """Get the height of the last diffmap once cropped to its used rows.
+
+        Returns:
+            int: the height in pixels
+
+        """
+
+        return max(self.tracker.rows_used, 1) * self.options['blocksize']
+
+    def _write_image(self, image, destination, quality):
+        """Write an image in the selected format.
+
+        Args:
+            image (``PIL.Image.Image`` instance): the image to write
+            destination (str or file): a file path or file object
+            quality (int): a JPEG quality setting (ignored for other formats)
+
+        """
+
+        if self.options['format'] == 'JPEG':
+            image.save(destination, 'JPEG', quality=quality, **Whitewater._JPEG_OPTIONS)
+        elif self.options['format'] == 'PNG':
+            image.save(destination, 'PNG', optimize=True)
+        else:
+            image.save(destination, 'GIF')
+
+    def _get_manifest(self):
+        """Build the contents of the manifest.json file.
+
+        Returns:
+            dict: the manifest
+
+        """
+
+        return {'version': 1,
+                'frameCount': len(self.frame_maps) + 1,
+                'blockSize': self.options['blocksize'],
+                'imagesRequired': self.tracker.diffmap_count,
+                'lastImageHeight': self._get_last_diffmap_height(),
+                'videoWidth': self.frame_size[0],
+                'videoHeight': self.frame_size[1],
+                'sourceGrid': self.options['grid'],
+                'framesPerSecond': self._get_frames_per_second(),
+                'format': self.options['format'],
+                'frames': self.frame_maps}
 
     def _save_manifest(self):
         """Create and save the manifest.json file."""
 
-        meta = self.video.get_meta_data()
         with open(self.paths['temp'] + '/manifest.json', 'w') as manifest:
-            json.dump({'version': 1,
-                       'frameCount': int(meta['nframes']),
-                       'blockSize': self.options['blocksize'],
-                       'imagesRequired': self.tracker.diffmap_count,
-                       'videoWidth': meta['source_size'][0],
-                       'videoHeight': meta['source_size'][1],
-                       'sourceGrid': self.options['grid'],
-                       'framesPerSecond': meta['fps'],
-                       'format': self.options['format'],
-                       'frames': self.frame_maps}, manifest, indent=4)
+            json.dump(self._get_manifest(), manifest, indent=4)
 
     def _process_frame(self, frame):
         """Prepare a frame to be processed.
@@ -372,10 +1037,27 @@ class Whitewater(object):
         self.tracker.set_next_frame(image)
 
         if frame_number == 1:
-            self.tracker.set_first_image(image)
+            self.tracker.set_first_image(numpy.array(image))
+        elif self._is_duplicate_frame():
+            self.frame_maps.append('')
         else:
             self._compare_to_previous_frame()
 
+    def _is_duplicate_frame(self):
+        """Check whether the current frame is identical to the previous one.
+
+        Comparing the raw pixel data is much cheaper than comparing every
+        block, and duplicate frames are common in screen captures and
+        telecined video.
+
+        Returns:
+            bool: ``True`` if the frames are identical.
+
+        """
+
+        previous = self.tracker.previous_frame.tobytes()
+        return previous == self.tracker.current_frame.tobytes()
+
 
     # hooks
 
@@ -424,6 +1106,28 @@ class Whitewater(object):
 
         pass
 
+    def _post_auto_tune_hook(self, blocksize, grid):
+        """Hook that runs after ``auto_tune`` has chosen its settings
+
+        Args:
+            blocksize (int): the chosen blocksize
+            grid (int): the chosen grid
+
+        """
+
+        pass
+
+    def _post_target_size_hook(self, quality, size):
+        """Hook that runs after saving when ``target_size`` is set
+
+        Args:
+            quality (int): the JPEG quality that was chosen
+            size (int): the size of the saved output in bytes
+
+        """
+
+        pass
+
 
     # static methods
 
@@ -443,6 +1147,126 @@ class Whitewater(object):
         name = os.path.splitext(filename)[0]
         return os.path.join(path, name)
 
+    @staticmethod
+    def _save_checkpoint_file(content, path, name):
+        """Atomically write an image or JSON state to a checkpoint directory.
+
+        Args:
+            content (``PIL.Image.Image`` or dict): what to write
+            path (str): the checkpoint directory
+            name (str): the file name
+
+        """
+
+        filename = os.path.join(path, name)
+        temp_filename = filename + '.tmp'
+
+        if isinstance(content, dict):
+            with open(temp_filename, 'w') as temp_file:
+                json.dump(content, temp_file)
+        else:
+            content.save(temp_filename, 'PNG', compress_level=1)
+
+        os.rename(temp_filename, filename)
+
+    @staticmethod
+    def _get_changed_blocks(previous, current, blocksize, threshold):
+        """Find the blocks that differ between two frames.
+
+        A block has changed when the RMS of its pixel differences is above
+        ``threshold``. Partial blocks at the edges are padded with black.
+
+        Args:
+            previous (``numpy.ndarray``): the previous frame
+            current (``numpy.ndarray``): the current frame
+            blocksize (int): the width/height of a block
+            threshold (float): the RMS threshold
+
+        Returns:
+            ``numpy.ndarray``: a rows by columns array, ``True`` where a block
+                has changed
+
+        """
+
+        height, width = previous.shape[:2]
+        rows = int(math.ceil(height / float(blocksize)))
+        columns = int(math.ceil(width / float(blocksize)))
+
+        diff = numpy.zeros((rows * blocksize, columns * blocksize, 3), numpy.int32)
+        diff[:height, :width] = numpy.abs(previous.astype(numpy.int32) - current)
+
+        squares = (diff ** 2).reshape(rows, blocksize, columns, blocksize, 3)
+        squares = squares.sum(axis=(1, 3, 4))
+
+        return numpy.sqrt(squares / float(blocksize * blocksize)) > threshold
+
+    @staticmethod
+    def _get_blocks(frame, changed, blocksize):
+        """Copy the changed blocks out of a frame.
+
+        Partial blocks at the edges are padded with black.
+
+        Args:
+            frame (``numpy.ndarray``): a frame
+            changed (``numpy.ndarray``): the changed block mask from
+                ``_get_changed_blocks()``
+            blocksize (int): the width/height of a block
+
+        Returns:
+            ``numpy.ndarray``: the changed blocks, row by row, as a count by
+                ``blocksize`` by ``blocksize`` by 3 array
+
+        """
+
+        rows, columns = changed.shape
+        height, width = frame.shape[:2]
+
+        padded = frame
+        if (height, width) != (rows * blocksize, columns * blocksize):
+            padded = numpy.zeros((rows * blocksize, columns * blocksize, 3), numpy.uint8)
+            padded[:height, :width] = frame
+
+        blocks = padded.reshape(rows, blocksize, columns, blocksize, 3).swapaxes(1, 2)
+        return blocks[changed]
+
+    @staticmethod
+    def _get_crop(value):
+        """Parse a crop region.
+
+        Args:
+            value (str or tuple): ``"x,y,width,height"`` or a 4-tuple
+
+        Returns:
+            (int, int, int, int): the region, or ``None`` for no crop
+
+        """
+
+        if not value:
+            return None
+
+        if isinstance(value, basestring):
+            value = value.split(',')
+
+        crop = tuple(int(part) for part in value)
+        if len(crop) != 4:
+            raise ValueError('crop must be x,y,width,height')
+
+        return crop
+
+    @staticmethod
+    def _get_directory_size(path):
+        """Return the total size of the files in a directory.
+
+        Args:
+            path (str): a directory path
+
+        Returns:
+            int: the size in bytes
+
+        """
+
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
     @staticmethod
     def _get_padded_string(string, length, char):
         """Pad a string by prepending characters.
@@ -470,27 +1294,6 @@ class Whitewater(object):
                 string = padding + string
                 return string
 
-    @staticmethod
-    def _get_box_coords(row, column, blocksize):
-        """Get coordinates to copy an image from.
-
-        Args:
-            row (int): The row of the image.
-            column (int): The column of the image.
-            blocksize (int): The size of a grid cell.
-
-        Returns:
-            (int, int, int, int): The coordinates of a box to copy from, in the
-                form top-left x, top-left y, bottom-right x, bottom-right y.
-        """
-        x_0 = column * blocksize
-        y_0 = row * blocksize
-        x_1 = x_0 + blocksize
-        y_1 = y_0 + blocksize
-
-        return (x_0, y_0, x_1, y_1)
-
-
     # class methods
 
     @classmethod
@@ -534,6 +1337,8 @@ class FrameTracker(object):
     """
 
     def __init__(self, block_size, max_size):
+        import_dependencies()
+
         self.__block_size = block_size
         self.__max_size = max_size
         self.__target = {'x': 0, 'y': 0}
@@ -567,16 +1372,22 @@ class FrameTracker(object):
 
     @property
     def diffmap(self):
-        """The current diffmap."""
+        """The current diffmap, as a ``numpy.ndarray``."""
 
         return self.__images[-1]
 
     @property
     def diffmaps(self):
-        """A list of all diffmaps."""
+        """The first image followed by every diffmap, as ``numpy.ndarray``s."""
 
         return self.__images
 
+    @property
+    def rows_used(self):
+        """The number of rows of the current diffmap that contain cells."""
+
+        return self.__target['y'] + (1 if self.__target['x'] else 0)
+
     @property
     def diffmap_count(self):
         """The number of diffmaps."""
@@ -587,7 +1398,7 @@ class FrameTracker(object):
         """Set the first image and create a blank diffmap.
 
         Args:
-            image (``PIL.Image.Image``): The first image.
+            image (``numpy.ndarray``): The first image.
         """
 
         self.__images.append(image)
@@ -603,16 +1414,36 @@ class FrameTracker(object):
         self.__previous_frame = self.__current_frame
         self.__current_frame = frame
 
+    def restore(self, images, cell, frame):
+        """Restore the state of an earlier encode.
+
+        Args:
+            images (list): The first image followed by every diffmap, as
+                ``numpy.ndarray``s.
+            cell ((int, int)): The x and y values of the next cell.
+            frame (``PIL.Image.Image``): The last frame that was encoded.
+        """
+
+        self.__images = images
+        self.__target['x'], self.__target['y'] = cell
+        self.__previous_frame = None
+        self.__current_frame = frame
+
     def reset(self):
         """Reset x and y values to 0."""
 
         self.__target['x'] = 0
         self.__target['y'] = 0
 
-    def next_cell(self):
-        """Advance to the next cell in the diffmap"""
+    def next_cell(self, count=1):
+        """Advance to the next cell in the diffmap
+
+        Args:
+            count (int): Number of cells to advance by, no more than are left
+                in the current row.
+        """
 
-        self.__target['x'] += 1
+        self.__target['x'] += count
         if self.__target['x'] >= self.__max_size:
             self.__target['x'] = 0
             self.__target['y'] += 1
@@ -625,7 +1456,104 @@ class FrameTracker(object):
 
         self.reset()
         size = self.__block_size * self.__max_size
-        self.__images.append(Image.new('RGB', (size, size), None))
+        self.__images.append(numpy.zeros((size, size, 3), numpy.uint8))
+
+
+def _decode_frames(path, crop, indices, previous, ring, tasks, results, workers):
+    """Decode frames into a ``FrameRing`` for a parallel encode.
+
+    Queues a ``(number, index, previous_slot, slot)`` task for every frame,
+    then an ``end`` message with the frame count and last slot.
+
+    Args:
+        path (str): path to the video file
+        crop ((int, int, int, int)): the crop region, or ``None``
+        indices (list): the source frame indices to decode
+        previous (``numpy.ndarray``): the frame before the first index when
+            resuming, otherwise ``None``
+        ring (``FrameRing``): where to write frames
+        tasks (``multiprocessing.Queue``): where to queue frame pairs
+        results (``multiprocessing.Queue``): where to send the end message
+        workers (int): number of comparison workers to stop afterwards
+
+    """
+
+    import_dependencies()
+
+    try:
+        video = imageio.get_reader(path)
+        previous_slot = None
+
+        if previous is not None:
+            previous_slot = ring.acquire()
+            ring.view(previous_slot)[...] = previous
+
+        count = 0
+        for index in indices:
+            try:
+                data = video.get_data(index)
+            except IndexError:
+                break
+
+            if crop:
+                x_0, y_0, width, height = crop
+                data = data[y_0:y_0 + height, x_0:x_0 + width]
+
+            slot = ring.acquire()
+            ring.view(slot)[...] = data
+            tasks.put((count, index, previous_slot, slot))
+
+            previous_slot = slot
+            count += 1
+
+        results.put(('end', count, previous_slot))
+    except Exception as err:
+        results.put(('error', str(err)))
+    finally:
+        for _ in range(workers):
+            tasks.put(None)
+
+
+def _compare_frames(ring, tiles, tasks, results, blocksize, threshold):
+    """Compare frame pairs from a ``FrameRing`` for a parallel encode.
+
+    Sends ``("frame", number, index, previous_slot, slot, changed, tile)`` for
+    every task, where ``changed`` is the block mask from
+    ``Whitewater._get_changed_blocks()``, or ``None`` if the frames are
+    identical, and ``tile`` is the slot of ``tiles`` holding the changed
+    blocks, row by row, or ``None`` with ``changed``.
+
+    Args:
+        ring (``FrameRing``): where to read frames
+        tiles (``FrameRing``): where to write changed blocks
+        tasks (``multiprocessing.Queue``): frame pairs to compare
+        results (``multiprocessing.Queue``): where to send the results
+        blocksize (int): the width/height of a block
+        threshold (float): the RMS threshold
+
+    """
+
+    import_dependencies()
+
+    try:
+        for number, index, previous_slot, slot in iter(tasks.get, None):
+            changed = None
+            tile = None
+
+            if previous_slot is not None:
+                previous = ring.view(previous_slot)
+                current = ring.view(slot)
+                if not numpy.array_equal(previous, current):
+                    changed = Whitewater._get_changed_blocks(previous, current,
+                                                             blocksize, threshold)
+                    blocks = Whitewater._get_blocks(current, changed, blocksize)
+
+                    tile = tiles.acquire()
+                    tiles.view(tile)[:len(blocks)] = blocks
+
+            results.put(('frame', number, index, previous_slot, slot, changed, tile))
+    except Exception as err:
+        results.put(('error', str(err)))
 
 
 class ProgramEnd(Exception):